@@ -12,7 +12,7 @@ First run will create a Telegraph account and save the token locally.
 
 import argparse
 from datetime import datetime
-import json
+from functools import lru_cache
 import os
 import re
 import sys
@@ -20,7 +20,8 @@ from pathlib import Path
 
 import requests
 import markdown
-from bs4 import BeautifulSoup
+import lxml.html
+import orjson
 
 # Telegraph API base URL
 API_BASE = "https://api.telegra.ph"
@@ -34,13 +35,75 @@ LOG_FILE = Path(__file__).parent / "log.txt"
 # Content size limit (~64KB)
 MAX_CONTENT_SIZE = 64000
 
-
+# Shared HTTP session so API calls reuse one connection to the Telegraph API
+_SESSION = requests.Session()
+
+# Markdown converter, built once; reset() clears per-document state between uses.
+# Footnotes and tables come out as tags in _TAG_MAP (table cells as paragraphs);
+# extensions that only add markup Telegraph drops (syntax highlighting,
+# abbreviations, attribute/definition lists, markdown in HTML) are left out.
+_MD = markdown.Markdown(
+    extensions=["fenced_code", "footnotes", "tables", "nl2br"],
+    output_format="html5"
+)
+
+# Map HTML tags to Telegraph-supported tags
+_TAG_MAP = {
+    "h1": "h3",
+    "h2": "h3",
+    "h3": "h4",
+    "h4": "h4",
+    "h5": "h4",
+    "h6": "h4",
+    "p": "p",
+    "a": "a",
+    "strong": "strong",
+    "b": "strong",
+    "em": "em",
+    "i": "em",
+    "u": "u",
+    "s": "s",
+    "strike": "s",
+    "del": "s",
+    "code": "code",
+    "pre": "pre",
+    "blockquote": "blockquote",
+    "ul": "ul",
+    "ol": "ol",
+    "li": "li",
+    "br": "br",
+    "hr": "hr",
+    "img": "img",
+    "figure": "figure",
+    "figcaption": "figcaption",
+    "aside": "aside",
+}
+
+# Telegraph tags that never have children
+_SELF_CLOSING = frozenset({"br", "hr"})
+
+# The single attribute Telegraph keeps for each tag that has one
+_ATTR_KEYS = {"a": "href", "img": "src"}
+
+# h1 title line, e.g. "# Title"; parse_front_matter matches it against the
+# stripped first non-blank line to find a fallback title
+_TITLE_RE = re.compile(r"#\s+(.+)")
+
+# Source link in the front-matter "Published:" line, e.g. "on [source](url)"
+_SOURCE_RE = re.compile(r'on \[([^\]]+)\]\(([^)]+)\)')
+
+
+@lru_cache(maxsize=None)
 def get_or_create_token(short_name: str = "anon") -> str:
-    """Get existing token or create a new Telegraph account."""
+    """
+    Get existing token or create a new Telegraph account.
+
+    Cached, so repeated uploads in one process read the token file only once.
+    """
     if TOKEN_FILE.exists():
         return TOKEN_FILE.read_text().strip()
 
-    response = requests.get(f"{API_BASE}/createAccount", params={
+    response = _SESSION.get(f"{API_BASE}/createAccount", params={
         "short_name": short_name
     })
     response.raise_for_status()
@@ -56,138 +119,96 @@ def get_or_create_token(short_name: str = "anon") -> str:
 
 
 def html_to_telegraph_nodes(html: str) -> list:
-    """Convert HTML to Telegraph's node format."""
-    soup = BeautifulSoup(html, "html.parser")
-
-    def process_element(element):
-        """Recursively process an HTML element into Telegraph nodes."""
-        if isinstance(element, str):
-            text = element
-            if text.strip():
-                return text
-            return None
-
-        tag_name = element.name
-
-        # Map HTML tags to Telegraph-supported tags
-        tag_map = {
-            "h1": "h3",
-            "h2": "h3",
-            "h3": "h4",
-            "h4": "h4",
-            "h5": "h4",
-            "h6": "h4",
-            "p": "p",
-            "a": "a",
-            "strong": "strong",
-            "b": "strong",
-            "em": "em",
-            "i": "em",
-            "u": "u",
-            "s": "s",
-            "strike": "s",
-            "del": "s",
-            "code": "code",
-            "pre": "pre",
-            "blockquote": "blockquote",
-            "ul": "ul",
-            "ol": "ol",
-            "li": "li",
-            "br": "br",
-            "hr": "hr",
-            "img": "img",
-            "figure": "figure",
-            "figcaption": "figcaption",
-            "aside": "aside",
-        }
-
-        telegraph_tag = tag_map.get(tag_name)
-
-        # Skip unsupported tags but process their children
-        if telegraph_tag is None:
-            children = []
-            for child in element.children:
-                processed = process_element(child)
-                if processed:
-                    if isinstance(processed, list):
-                        children.extend(processed)
-                    else:
-                        children.append(processed)
-            return children if children else None
-
-        # Build the node
-        node = {"tag": telegraph_tag}
-
-        # Handle attributes
-        attrs = {}
-        if tag_name == "a" and element.get("href"):
-            attrs["href"] = element["href"]
-        if tag_name == "img" and element.get("src"):
-            attrs["src"] = element["src"]
-
-        if attrs:
-            node["attrs"] = attrs
-
-        # Handle self-closing tags
-        if telegraph_tag in ("br", "hr"):
-            return node
-
-        # Process children
-        children = []
-        for child in element.children:
-            processed = process_element(child)
-            if processed:
-                if isinstance(processed, list):
-                    children.extend(processed)
-                else:
-                    children.append(processed)
-
-        if children:
-            node["children"] = children
-
-        return node
+    """
+    Convert HTML to Telegraph's node format.
 
+    lxml repairs the markup the way a browser would: a block element inside
+    a <p> (e.g. inline raw <div>, <ul> or <blockquote>) closes the paragraph,
+    so it and the text around it become sibling nodes. NUL characters become
+    U+FFFD, and comments and doctypes are dropped.
+    """
+    root = lxml.html.fragment_fromstring(html, create_parent="div")
+
+    # Walk the tree with an explicit stack instead of recursion. Each entry is
+    # (item, target): a tail string or element to be appended to the target
+    # children list, or a node dict whose collected children are the target.
     nodes = []
-    for element in soup.children:
-        processed = process_element(element)
-        if processed:
-            if isinstance(processed, list):
-                nodes.extend(processed)
-            else:
-                nodes.append(processed)
+    stack = [(root, nodes)]
 
-    # Wrap plain text in paragraphs
-    final_nodes = []
-    for node in nodes:
-        if isinstance(node, str):
-            final_nodes.append({"tag": "p", "children": [node]})
+    while stack:
+        item, target = stack.pop()
+
+        # Text: skip whitespace-only runs (isspace avoids building a stripped copy)
+        if isinstance(item, str):
+            if not item.isspace():
+                target.append(item)
+            continue
+
+        # Node finished: attach its children once they have all been processed
+        if isinstance(item, dict):
+            if target:
+                item["children"] = target
+            continue
+
+        tag_name = item.tag
+
+        # Comments and processing instructions have a non-string tag
+        if not isinstance(tag_name, str):
+            continue
+
+        telegraph_tag = _TAG_MAP.get(tag_name)
+
+        # Skip unsupported tags but process their children into the parent
+        if telegraph_tag is None:
+            children = target
         else:
-            final_nodes.append(node)
+            # Build the node
+            node = {"tag": telegraph_tag}
 
-    return final_nodes
+            # Handle attributes
+            key = _ATTR_KEYS.get(tag_name)
+            if key and (value := item.get(key)):
+                node["attrs"] = {key: value}
+
+            target.append(node)
+
+            # Handle self-closing tags
+            if telegraph_tag in _SELF_CLOSING:
+                continue
+
+            children = []
+            stack.append((node, children))
+
+        # Leading text comes before everything still on the stack, so it can
+        # be added straight away
+        text = item.text
+        if text and not text.isspace():
+            children.append(text)
+
+        # Push child elements and their tails in reverse so they are popped
+        # in document order
+        for child in reversed(item):
+            if child.tail:
+                stack.append((child.tail, children))
+            stack.append((child, children))
+
+    # Wrap plain text in paragraphs
+    return [
+        {"tag": "p", "children": [node]} if isinstance(node, str) else node
+        for node in nodes
+    ]
 
 
 def markdown_to_telegraph_nodes(md_content: str) -> list:
     """Convert Markdown to Telegraph nodes."""
     # Convert markdown to HTML
-    html = markdown.markdown(
-        md_content,
-        extensions=["extra", "codehilite", "nl2br"]
-    )
+    html = _MD.reset().convert(md_content)
 
     # Convert HTML to Telegraph nodes
     return html_to_telegraph_nodes(html)
 
 
-def extract_title_from_markdown(md_content: str) -> str | None:
-    """Try to extract a title from the markdown (first h1)."""
-    match = re.match(r"^#\s+(.+)$", md_content.strip(), re.MULTILINE)
-    if match:
-        return match.group(1).strip()
-    return None
-
-
-def parse_front_matter(md_content: str) -> tuple[dict, str]:
+def parse_front_matter(md_content: str) -> tuple[dict, str | None, str | None]:
     """
     Parse front-matter from markdown content.
 
@@ -199,15 +220,36 @@ def parse_front_matter(md_content: str) -> tuple[dict, str]:
         ---
         Body content...
 
+    The same scan also picks up an h1 on the first non-blank line, used as a
+    fallback title when the front-matter has none.
+
     Returns:
-        (metadata dict, body content without front-matter)
+        (metadata dict, body content without front-matter, first-line title).
+        The body is None if no front-matter was found and the original content
+        should be used; the title is None if the first line is not an h1.
     """
     metadata = {}
-    lines = md_content.split('\n')
     body_start = 0
-
-    for i, line in enumerate(lines):
-        stripped = line.strip()
+    first_title = None
+    seen_first_line = False
+
+    # Scan line by line only as far as the header goes, without splitting
+    # the whole document
+    pos = 0
+    length = len(md_content)
+    while pos < length:
+        end = md_content.find('\n', pos)
+        if end == -1:
+            end = length
+        stripped = md_content[pos:end].strip()
+        pos = end + 1
+
+        # Fallback title: h1 on the first non-blank line
+        if stripped and not seen_first_line:
+            seen_first_line = True
+            title_match = _TITLE_RE.match(stripped)
+            if title_match:
+                first_title = title_match.group(1).strip()
 
         # Title line
         if stripped.startswith('# '):
@@ -223,10 +265,11 @@ def parse_front_matter(md_content: str) -> tuple[dict, str]:
         if stripped.startswith('Published:'):
             metadata['published'] = stripped
             # Extract the source link: "on [source](url)"
-            source_match = re.search(r'on \[([^\]]+)\]\(([^)]+)\)', stripped)
-            if source_match:
-                metadata['source_name'] = source_match.group(1)
-                metadata['source_url'] = source_match.group(2)
+            if 'on [' in stripped:
+                source_match = _SOURCE_RE.search(stripped)
+                if source_match:
+                    metadata['source_name'] = source_match.group(1)
+                    metadata['source_url'] = source_match.group(2)
             continue
 
         # Word count line
@@ -236,7 +279,7 @@ def parse_front_matter(md_content: str) -> tuple[dict, str]:
 
         # Horizontal rule marks end of front-matter
         if stripped == '---':
-            body_start = i + 1
+            body_start = pos
             break
 
         # Empty lines in front-matter are ok
@@ -248,24 +291,41 @@ def parse_front_matter(md_content: str) -> tuple[dict, str]:
 
     # If we found front-matter, return body without it
     if metadata and body_start > 0:
-        body = '\n'.join(lines[body_start:]).strip()
-        return metadata, body
+        body = md_content[body_start:].strip()
+        return metadata, body, first_title
 
-    # No front-matter found, return original content
-    return {}, md_content
+    # No front-matter found, caller uses the original content
+    return {}, None, first_title
 
 
-def create_page(token: str, title: str, content: list, author_name: str = None) -> dict:
-    """Create a Telegraph page."""
-    content_json = json.dumps(content)
+def check_content_size(content_json: bytes) -> None:
+    """Raise if encoded content exceeds Telegraph's size limit."""
+    content_size = len(content_json)
 
-    # Check size limit
-    if len(content_json) > MAX_CONTENT_SIZE:
+    if content_size > MAX_CONTENT_SIZE:
         raise Exception(
-            f"Content too large: {len(content_json)} bytes "
+            f"Content too large: {content_size} bytes "
             f"(max {MAX_CONTENT_SIZE} bytes, ~{MAX_CONTENT_SIZE // 1000}KB)"
         )
 
+
+def create_page(token: str, title: str, content_json: bytes | list, author_name: str = None) -> dict:
+    """
+    Create a Telegraph page.
+
+    content_json is the orjson-encoded node list; a plain node list is also
+    accepted and encoded here.
+    """
+    if isinstance(content_json, list):
+        content_json = orjson.dumps(content_json)
+    elif not isinstance(content_json, bytes):
+        raise TypeError(
+            f"content_json must be bytes or a node list, not {type(content_json).__name__}"
+        )
+
+    # Check size limit before building the request
+    check_content_size(content_json)
+
     data = {
         "access_token": token,
         "title": title[:256],  # Telegraph title limit
@@ -276,7 +336,7 @@ def create_page(token: str, title: str, content: list, author_name: str = None)
     if author_name:
         data["author_name"] = author_name[:128]  # Telegraph author limit
 
-    response = requests.post(f"{API_BASE}/createPage", data=data)
+    response = _SESSION.post(f"{API_BASE}/createPage", data=data)
     response.raise_for_status()
     result = response.json()
 
@@ -296,10 +356,10 @@ def blank_page(token: str, path: str) -> dict:
         "access_token": token,
         "path": path,
         "title": "[Removed]",
-        "content": json.dumps([{"tag": "p", "children": ["[This page has been removed]"]}])
+        "content": orjson.dumps([{"tag": "p", "children": ["[This page has been removed]"]}])
     }
 
-    response = requests.post(f"{API_BASE}/editPage", data=data)
+    response = _SESSION.post(f"{API_BASE}/editPage", data=data)
     response.raise_for_status()
     result = response.json()
 
@@ -309,7 +369,19 @@ def blank_page(token: str, path: str) -> dict:
     return result["result"]
 
 
-def main():
+def log_published(log_fp, url: str, title: str) -> None:
+    """Append a published URL to an open log file (timestamp, URL, title)."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log_fp.write(f"{timestamp}\t{url}\t{title}\n")
+
+
+def main(argv: list[str] = None, log_fp=None):
+    """
+    Run the command line tool.
+
+    Batch callers can pass argv for each upload and an already-open log_fp
+    to reuse one log file handle across uploads instead of reopening LOG_FILE.
+    """
     parser = argparse.ArgumentParser(
         description="Upload a Markdown file to Telegraph"
     )
@@ -319,7 +391,7 @@ def main():
     parser.add_argument("--account-name", default="anon", help="Short name for new Telegraph account")
     parser.add_argument("--blank", "-b", metavar="PATH", help="Blank out a page (provide path or full URL)")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Get or create token
     token = get_or_create_token(args.account_name)
@@ -344,40 +416,44 @@ def main():
     md_content = md_path.read_text(encoding="utf-8")
 
     # Parse front-matter if present
-    metadata, body_content = parse_front_matter(md_content)
+    metadata, body_content, first_title = parse_front_matter(md_content)
 
     # Determine title (priority: CLI arg > front-matter > first h1 > filename)
-    title = args.title or metadata.get('title') or extract_title_from_markdown(md_content) or md_path.stem
+    title = args.title or metadata.get('title') or first_title or md_path.stem
 
     # Determine author (priority: CLI arg > front-matter)
     author = args.author or metadata.get('author')
 
+    # Use body content (without front-matter) if front-matter was found
+    content_to_convert = body_content if body_content is not None else md_content
+
     # Prepend "via [source](url)" if source link was in front-matter
     if metadata.get('source_url'):
         source_line = f"via [{metadata['source_name']}]({metadata['source_url']})\n\n"
-        body_content = source_line + body_content
-
-    # Use body content (without front-matter) if front-matter was found
-    content_to_convert = body_content if metadata else md_content
+        content_to_convert = source_line + content_to_convert
 
     # Convert markdown to Telegraph nodes
     print(f"Converting: {md_path.name}")
     nodes = markdown_to_telegraph_nodes(content_to_convert)
 
-    content_size = len(json.dumps(nodes))
+    # Encode once; the same bytes are reported here and sent by create_page
+    content_json = orjson.dumps(nodes)
+    content_size = len(content_json)
     print(f"Content size: {content_size:,} bytes ({content_size * 100 // MAX_CONTENT_SIZE}% of limit)")
 
     # Create the page
     print(f"Uploading: \"{title}\"")
-    result = create_page(token, title, nodes, author)
+    result = create_page(token, title, content_json, author)
 
     print(f"\nPublished: {result['url']}")
     print(f"Path: {result['path']}")
 
     # Log the published URL
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(f"{timestamp}\t{result['url']}\t{title}\n")
+    if log_fp is not None:
+        log_published(log_fp, result["url"], title)
+    else:
+        with open(LOG_FILE, "a", buffering=1, encoding="utf-8") as f:
+            log_published(f, result["url"], title)
 
     return result["url"]
 